@@ -1,12 +1,23 @@
 # app.py
+from __future__ import annotations
+
 import io
+import re
 import time
 import datetime as dt
-from typing import List, Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, List, Dict, Any, Optional, Tuple
 
-import pandas as pd
+import orjson
 import requests
+import requests_cache
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from urllib3.util.retry import Retry
+
+if TYPE_CHECKING:  # pandas/numpy are imported lazily inside the functions that need them
+    import pandas as pd
 
 # -----------------------------
 # App config
@@ -17,6 +28,10 @@ st.title("💱 FX Timeseries Downloader (exchangerate.host)")
 st.caption("Query historical FX rates for a chosen month/year (or custom dates) and export to Excel.")
 
 API_BASE = "https://api.exchangerate.host"   # we use the /timeframe endpoint
+HTTP_CACHE_NAME = "fx_cache"                 # on-disk response cache -> fx_cache.sqlite
+MAX_TIMEFRAME_DAYS = 365                     # provider cap on a single /timeframe call
+FETCH_WORKERS = 4                            # parallel calls for ranges above the cap
+REQUEST_TIMEOUT = (5, 30)                    # (connect, read) seconds: fail fast on DNS/connect hangs
 
 # -----------------------------
 # Secrets helper
@@ -36,13 +51,53 @@ def get_api_key_from_secrets_or_input() -> Optional[str]:
         )
         return st.text_input("API key (masked)", type="password", key="api_key_input") or None
 
+# -----------------------------
+# HTTP session (shared, pooled)
+# -----------------------------
+_ERROR_ENVELOPE = re.compile(rb'"success"\s*:\s*false')
+
+def _is_cacheable(response: requests.Response) -> bool:
+    """
+    Only persist successful payloads. exchangerate.host reports errors as HTTP 200
+    with "success": false, so check for that with a byte scan rather than decoding
+    the body a second time (fetch_timeframe parses it once).
+    """
+    return response.status_code == 200 and not _ERROR_ENVELOPE.search(response.content)
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """
+    One keep-alive session per process so repeated cache misses reuse the
+    TCP/TLS connection to the API host instead of handshaking every time.
+    Responses are also persisted to a local SQLite cache, so identical queries
+    survive app restarts, and the last known response is served if the API is
+    unreachable. Transient failures (429/5xx) are retried with a short backoff.
+    """
+    session = requests_cache.CachedSession(
+        HTTP_CACHE_NAME,
+        backend="sqlite",
+        expire_after=60 * 60 * 24,
+        allowable_methods=["GET"],
+        ignored_parameters=["access_key"],  # keep the key out of cache keys and the file
+        filter_fn=_is_cacheable,
+        stale_if_error=True,
+    )
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    session.headers["User-Agent"] = "fx-timeseries-app/1.0"
+    session.mount("https://", HTTPAdapter(pool_maxsize=max(10, FETCH_WORKERS), max_retries=retry))
+    return session
+
 # -----------------------------
 # API call (single request, cached)
 # -----------------------------
-@st.cache_data(ttl=60 * 60 * 24)  # cache for 24 hours to respect limited quota
+def _normalize_currencies(currencies: Iterable[str]) -> str:
+    """Canonical 'AAA,BBB,...' string for the API and the cache key (sorted, de-duplicated)."""
+    return ",".join(sorted(set(currencies)))
+
+@st.cache_data(ttl=60 * 60 * 24, show_spinner=False)  # cache for 24 hours to respect limited quota
 def fetch_timeframe(
     access_key: str,
-    currencies: List[str],
+    currencies_csv: str,
     start_date: dt.date,
     end_date: dt.date,
     pause_seconds: float = 0.0,
@@ -50,6 +105,8 @@ def fetch_timeframe(
     """
     Calls /timeframe once. We don't send 'source' so it uses the provider default (often USD).
     We then convert locally to the requested base later.
+    `currencies_csv` comes from _normalize_currencies: it is part of the cache key,
+    and normalising once up front keeps chunked fan-outs from redoing it per call.
     """
     if pause_seconds > 0:
         time.sleep(pause_seconds)
@@ -58,19 +115,26 @@ def fetch_timeframe(
         "access_key": access_key,
         "start_date": start_date.isoformat(),
         "end_date": end_date.isoformat(),
-        "currencies": ",".join(sorted(set(currencies))) if currencies else None,
+        "currencies": currencies_csv or None,
         "format": 1,  # request JSON with full precision if supported
     }
     params = {k: v for k, v in params.items() if v is not None}
 
     url = f"{API_BASE}/timeframe"
-    resp = requests.get(url, params=params, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
-
-    # Typical error envelope from exchangerate.host
-    if not data.get("success", True) and "error" in data:
-        raise RuntimeError(f"API error: {data['error'].get('info','unknown error')}")
+    resp = get_http_session().get(url, params=params, timeout=REQUEST_TIMEOUT)
+    if resp.status_code >= 500:
+        resp.raise_for_status()
+    try:
+        data = orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        resp.raise_for_status()  # non-JSON 4xx: report the HTTP error
+        raise
+
+    # Typical error envelope from exchangerate.host (parsed once, also on 4xx)
+    if not data.get("success", True):
+        raise RuntimeError(f"API error: {(data.get('error') or {}).get('info', 'unknown error')}")
+    if resp.status_code >= 400:
+        resp.raise_for_status()
 
     # Ensure we have date->rates/quotes
     if not any(k in data for k in ("rates", "quotes")):
@@ -78,113 +142,176 @@ def fetch_timeframe(
 
     return data
 
-# -----------------------------
-# JSON -> DataFrame conversion
-# -----------------------------
-def _convert_quotes_block_to_base(day_block: Dict[str, float], base: str) -> Dict[str, float]:
-    """
-    For 'quotes' style data like {'USDEUR': 0.91, 'USDGBP': 0.78, ...}
-    Return dict mapping currency->rate in 'base' terms using:
-      (USD->cur) / (USD->base) = base->cur
-    Also ensures a USD column exists: USD in base = 1 / (USD->base).
-    """
-    usd_to = {}
-    for pair, val in day_block.items():
-        # defensive parse: take last 3 letters as currency
-        cur = pair[-3:]
-        usd_to[cur] = float(val)
-
-    if base not in usd_to:
-        # can't convert this day if base not present
-        return {}
-
-    base_row = {c: (usd_to[c] / usd_to[base]) for c in usd_to.keys()}
-    base_row[base] = 1.0
-    # Explicit USD column (important for export when USD selected)
-    base_row["USD"] = 1.0 / usd_to[base]
-    return base_row
-
-def _convert_rates_block_to_base(day_block: Dict[str, float], base: str) -> Dict[str, float]:
+def _date_chunks(
+    start_date: dt.date, end_date: dt.date, max_days: int = MAX_TIMEFRAME_DAYS
+) -> List[Tuple[dt.date, dt.date]]:
+    """Split [start_date, end_date] into consecutive windows of at most max_days days."""
+    chunks = []
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(chunk_start + dt.timedelta(days=max_days - 1), end_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + dt.timedelta(days=1)
+    return chunks
+
+def fetch_timeframe_range(
+    access_key: str,
+    currencies_csv: str,
+    start_date: dt.date,
+    end_date: dt.date,
+    pause_seconds: float = 0.0,
+) -> Dict[str, Any]:
     """
-    For 'rates' style data like {'EUR': 0.91, 'GBP': 0.78, ...} all vs a hidden provider base (often USD).
-    Convert to chosen base using: cur_in_base = (rate[cur] / rate[base]).
-    Also ensure a USD column: USD in base = 1 / rate[base].
+    Like fetch_timeframe, but for ranges longer than the provider allows in one
+    call: the range is split into windows that are fetched in parallel over the
+    shared session and merged back into a single 'quotes'/'rates' payload.
+    Windows are released pause_seconds apart, so the throttle still staggers calls.
+    Ranges within the cap still make exactly one (cached) call.
     """
-    r = {k: float(v) for k, v in day_block.items()}
-    if base not in r:
-        return {}
-    converted = {c: (r[c] / r[base]) for c in r.keys()}
-    converted[base] = 1.0
-    # Ensure USD column (works when underlying provider base is USD)
-    converted.setdefault("USD", 1.0 / r[base])
-    return converted
+    chunks = _date_chunks(start_date, end_date)
+    if len(chunks) == 1:
+        return fetch_timeframe(access_key, currencies_csv, start_date, end_date, pause_seconds)
+
+    # Window i is released at t0 + i * pause_seconds on a shared clock, so the
+    # schedule doesn't stack up when the pool is smaller than the number of
+    # windows. The sleep stays outside the cached call, which keeps its key stable.
+    t0 = time.monotonic()
+
+    def fetch_window(i: int, chunk: Tuple[dt.date, dt.date]) -> Dict[str, Any]:
+        time.sleep(max(0.0, t0 + i * pause_seconds - time.monotonic()))
+        return fetch_timeframe(access_key, currencies_csv, chunk[0], chunk[1], pause_seconds)
+
+    # Worker threads need the script context to use st.cache_data.
+    with ThreadPoolExecutor(
+        max_workers=FETCH_WORKERS, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())
+    ) as ex:
+        parts = list(ex.map(fetch_window, range(len(chunks)), chunks))
+
+    merged: Dict[str, Any] = {}
+    for part in parts:
+        for key in ("quotes", "rates"):
+            if part.get(key):
+                merged.setdefault(key, {}).update(part[key])
+    return merged
 
+# -----------------------------
+# JSON -> DataFrame conversion
+# -----------------------------
 def timeframe_to_dataframe(data: Dict[str, Any], base: str) -> pd.DataFrame:
     """
     Handles both schemas:
       1) {'quotes': {'YYYY-MM-DD': {'USDEUR': x, 'USDGBP': y, ...}, ...}}
       2) {'rates' : {'YYYY-MM-DD': {'EUR': x, 'GBP': y, ...}, ...}}
+    Both are quoted against a provider base (often USD), so every day is
+    rebased in one vectorised divide: cur_in_base = rate[cur] / rate[base].
     Returns DataFrame indexed by date with columns for each currency (base first).
     """
-    container = data.get("quotes") or data.get("rates") or {}
-    rows = []
-
-    for date_str, block in container.items():
-        if not isinstance(block, dict):
-            # Some providers nest differently; try 'quotes'/'rates' child
-            block = block.get("quotes") or block.get("rates") or {}
-
-        if data.get("quotes") is not None:
-            converted = _convert_quotes_block_to_base(block, base)
-        else:
-            converted = _convert_rates_block_to_base(block, base)
-
-        if not converted:
-            # skip dates we cannot convert (e.g., base missing)
-            continue
+    import numpy as np
+    import pandas as pd
+
+    # Decide the schema once: an empty 'quotes' alongside populated 'rates'
+    # must be read as 'rates', not converted with the quotes rules.
+    is_quotes = bool(data.get("quotes"))
+    container = data["quotes"] if is_quotes else data.get("rates") or {}
+    if not container:
+        return pd.DataFrame()
 
-        converted["date"] = pd.to_datetime(date_str)
-        rows.append(converted)
+    # one bulk cast instead of per-value float(); JSON ints (e.g. USDUSD: 1) become floats
+    df = pd.DataFrame.from_dict(container, orient="index", dtype="float64")
+    if is_quotes:
+        # 'USDEUR' -> 'EUR': take last 3 letters as currency
+        df.columns = df.columns.str[-3:]
 
-    if not rows:
+    if base not in df.columns:
+        return pd.DataFrame()
+    # skip dates we cannot convert (base missing that day)
+    df = df[df[base].notna()]
+    if df.empty:
         return pd.DataFrame()
 
-    df = pd.DataFrame(rows).sort_values("date").set_index("date")
-    cols = [base] + sorted([c for c in df.columns if c != base])
-    return df[cols]
-
-def make_excel_download(df: pd.DataFrame, meta: Dict[str, Any]) -> bytes:
+    # One broadcast divide over the whole (days x currencies) block on the raw
+    # arrays, skipping pandas' index alignment.
+    base_rates = df[base].to_numpy()
+    converted = pd.DataFrame(df.to_numpy() / base_rates[:, None], index=df.index, columns=df.columns)
+    converted[base] = 1.0
+    # Explicit USD column (important for export when USD selected):
+    # USD in base = 1 / (USD->base) when the provider base is USD.
+    if is_quotes or "USD" not in converted.columns:
+        converted["USD"] = np.reciprocal(base_rates)
+
+    # explicit ISO format takes the fast C parser instead of dateutil inference
+    converted.index = pd.to_datetime(converted.index, format="%Y-%m-%d", cache=True)
+    converted.index.name = "date"
+    converted = converted.sort_index()
+    cols = [base] + sorted([c for c in converted.columns if c != base])
+    # Arrow-backed columns: contiguous buffers for st.dataframe and the export
+    # (astype rather than convert_dtypes, which would turn the all-1.0 base into ints).
+    return converted[cols].astype("float64[pyarrow]")
+
+@st.cache_data(ttl=60 * 60 * 24, max_entries=32, show_spinner=False)  # bounded: bytes live in process memory
+def make_excel_download(df: pd.DataFrame, meta: Tuple[Tuple[str, str], ...]) -> bytes:
     """
     Build an .xlsx in-memory file with a 'Rates' sheet and a small 'Meta' sheet.
+    Cached on (df, meta) so reruns with the same result reuse the bytes; meta is
+    a tuple of (key, value) pairs to keep the cache key hashable and ordered.
+    The 'Generated' row is stamped here, so it reflects when the bytes were built;
+    the 24h ttl and max_entries bound both the memory held and the stamp's age.
+    xlsxwriter runs in constant_memory mode, which flushes each row to disk as
+    soon as the next one starts, so memory stays flat for multi-year ranges.
+    That mode requires writing strictly row by row (pandas' to_excel writes
+    column by column and would silently drop cells), so both sheets are
+    written with the native xlsxwriter API.
     """
+    import pandas as pd
+
     buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-        df.to_excel(writer, sheet_name="Rates")
-        meta_df = pd.DataFrame({"Key": list(meta.keys()), "Value": [str(v) for v in meta.values()]})
-        meta_df.to_excel(writer, sheet_name="Meta", index=False)
+    with pd.ExcelWriter(
+        buffer, engine="xlsxwriter", engine_kwargs={"options": {"constant_memory": True}}
+    ) as writer:
+        book = writer.book
+        header_fmt = book.add_format({"bold": True})
+        date_fmt = book.add_format({"num_format": "yyyy-mm-dd"})
+
+        rates_ws = book.add_worksheet("Rates")
+        rates_ws.write_row(0, 0, [df.index.name or "date", *df.columns], header_fmt)
+        # NaN -> None so missing rates become blank cells
+        cells = df.astype(object).where(df.notna(), None)
+        for i, (day, *rates) in enumerate(cells.itertuples(name=None), start=1):
+            rates_ws.write_datetime(i, 0, day, date_fmt)
+            rates_ws.write_row(i, 1, rates)
+
+        meta_ws = book.add_worksheet("Meta")
+        meta_ws.write_row(0, 0, ["Key", "Value"], header_fmt)
+        generated = dt.datetime.utcnow().isoformat(timespec="seconds") + "Z"
+        for i, row in enumerate([*meta, ("Generated", generated)], start=1):
+            meta_ws.write_row(i, 0, row)
     buffer.seek(0)
     return buffer.read()
 
 # -----------------------------
 # UI controls
 # -----------------------------
+# Fixed for the life of the process, so sort/filter once rather than on every rerun.
+common_currencies = [
+    "GBP","EUR","USD","CHF","JPY","AUD","CAD","NZD","SEK","NOK","DKK",
+    "PLN","CZK","HUF","TRY","ZAR","CNY","HKD","SGD","INR","MXN","BRL"
+]
+SORTED_CURRENCIES = sorted(common_currencies)
+DEFAULT_BASE_INDEX = SORTED_CURRENCIES.index("GBP")
+TARGET_OPTIONS = {c: [x for x in SORTED_CURRENCIES if x != c] for c in SORTED_CURRENCIES}
+
 with st.sidebar:
     st.header("🔧 Query Options")
 
-    common_currencies = [
-        "GBP","EUR","USD","CHF","JPY","AUD","CAD","NZD","SEK","NOK","DKK",
-        "PLN","CZK","HUF","TRY","ZAR","CNY","HKD","SGD","INR","MXN","BRL"
-    ]
-
     base = st.selectbox(
         "Base currency",
-        options=sorted(common_currencies),
-        index=sorted(common_currencies).index("GBP"),
+        options=SORTED_CURRENCIES,
+        index=DEFAULT_BASE_INDEX,
     )
 
     symbols = st.multiselect(
         "Target currencies",
-        options=[c for c in sorted(common_currencies) if c != base],
+        options=TARGET_OPTIONS[base],
         default=["EUR", "USD", "CHF"],
     )
 
@@ -207,7 +334,8 @@ with st.sidebar:
 
     throttle = st.slider(
         "Request throttle (seconds)", 0.0, 2.0, 0.0, 0.1,
-        help="Optional pause before sending the request (quota friendly)."
+        help="Optional pause before sending the request (quota friendly). "
+             "Ranges over a year are split into several calls, released this far apart."
     )
 
     run_btn = st.button("Fetch rates")
@@ -229,13 +357,13 @@ if run_btn:
         st.stop()
 
     # Request the target currencies **plus** the base so we can convert.
-    requested = sorted(set(symbols + [base]))
+    requested = _normalize_currencies(symbols + [base])
 
     with st.spinner("Calling exchangerate.host /timeframe…"):
         try:
-            raw = fetch_timeframe(
+            raw = fetch_timeframe_range(
                 access_key=api_key,
-                currencies=requested,
+                currencies_csv=requested,
                 start_date=start_date,
                 end_date=end_date,
                 pause_seconds=throttle,
@@ -269,9 +397,8 @@ if run_btn:
         "Start": start_date,
         "End": end_date,
         "Endpoint": "/timeframe",
-        "Generated": dt.datetime.utcnow().isoformat(timespec="seconds") + "Z",
     }
-    xlsx_bytes = make_excel_download(df, meta)
+    xlsx_bytes = make_excel_download(df, tuple((k, str(v)) for k, v in meta.items()))
     st.download_button(
         label="⬇️ Download .xlsx",
         data=xlsx_bytes,
@@ -281,7 +408,7 @@ if run_btn:
 
     # Quick stats
     with st.expander("Quick stats (min / max / mean)"):
-        stats = df.describe().loc[["min", "max", "mean"]]
+        stats = df.agg(["min", "max", "mean"])
         st.dataframe(stats.style.format("{:.6f}"), use_container_width=True)
 
 else: